@@ -9,11 +9,24 @@
 ####################################################################
 
 import argparse
-from datetime import date
+import base64
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, time, timedelta, timezone
+import http.client
 import json
+import os
 import re
+import shlex
 import subprocess
+import sys
+import tempfile
 import threading
+import urllib.error
+import urllib.request
+
+# boto3 and botocore are imported on first use, see importBoto3()
+boto3 = None
+Config = None
 
 
 # Default values
@@ -23,6 +36,67 @@ DEBUG      = False
 DEBUG_AUTH = False
 INFO       = True
 
+# Maximum number of concurrent AWS API requests
+MAX_AWS_THREADS = 20
+
+# Number of items requested per page when listing repositories and images
+# 1000 is the maximum allowed by ECR API, default is 100
+AWS_PAGE_SIZE = 1000
+
+# ECR authorization tokens are cached in this directory under
+# $XDG_CACHE_HOME (~/.cache by default), and are not reused when they
+# expire within the margin
+TOKEN_CACHE_NAME = 'aws-ecr-cross-account-clone'
+TOKEN_EXPIRY_MARGIN = timedelta(minutes=5)
+
+# Image properties used for synchronization, others are dropped
+IMAGE_FIELDS = ('repositoryName', 'imageDigest', 'imageTags', 'imagePushedAt', 'imageScanStatus')
+
+# Manifest types accepted when copying images by manifest
+MANIFEST_MEDIA_TYPES = ['application/vnd.docker.distribution.manifest.v2+json',
+                        'application/vnd.docker.distribution.manifest.list.v2+json',
+                        'application/vnd.oci.image.manifest.v1+json',
+                        'application/vnd.oci.image.index.v1+json']
+
+# Maximum number of images cloned by docker simultaneously
+MAX_DOCKER_THREADS = 6
+
+# Timeout for checking credentials at registry, in seconds
+REGISTRY_TIMEOUT = 30
+
+# Retry policy for AWS API requests
+# Adaptive mode retries throttled requests with exponential backoff and
+# jitter, and additionally rate-limits the client once throttling starts
+AWS_RETRY_ATTEMPTS = 10
+
+# Regular expressions, compiled once
+reProfileName    = re.compile(r'^[a-z0-9\-_]+$')
+reRegionName     = re.compile(r'^[a-z0-9\-]+$')
+reRepositoryName = re.compile(r'^[a-zA-Z0-9\-_]+$')
+# docker errors caused by rejected or expired registry credentials
+reDockerAuthError = re.compile(r'no basic auth credentials|authorization token|unauthorized|authentication required', re.IGNORECASE)
+
+# Cached boto3 sessions by profile, and clients by (service, profile, region)
+awsSessions = {}
+awsClients = {}
+awsClientsLock = threading.Lock()
+
+# Serializes updates of docker config file by login threads
+dockerConfigLock = threading.Lock()
+
+# Errors raised by helpers
+# Callers decide whether an error is fatal: worker threads report it as
+# failed result, main process exits with corresponding exit code.
+class AWSError(Exception):
+  pass
+
+class DockerError(Exception):
+  pass
+
+# Registry rejected credentials
+class DockerAuthError(DockerError):
+  pass
+
 # Exit codes
 errInvalidArgument  = 1
 errInvalidFile      = 2
@@ -32,84 +106,155 @@ errDocker           = 22
 
 
 # Debug level printing
-def debug(message):
+# Message is formatted with printf-style arguments, if any, only when
+# it is actually printed. Messages from worker threads are prefixed with
+# thread name, and are printed with the line end at once, so that lines
+# from concurrent threads are not mixed.
+def debug(message, *args):
   if DEBUG:
-    print(message)
+    message = message % args if args else str(message)
+    thread = threading.current_thread()
+    if thread is not threading.main_thread():
+      message = '[' + thread.name + '] ' + message
+    print(message + '\n', end='')
 
     
 # Info level printing
-def info(message):
+def info(message, *args):
   if INFO:
-    print(message)
+    message = message % args if args else str(message)
+    print(message + '\n', end='')
+
+    
+# Error printing
+# Always printed, at once with the line end, like debug() and info(),
+# as errors are reported by concurrent worker threads.
+def error(message, *args):
+  message = message % args if args else str(message)
+  print(message + '\n', end='')
 
     
-# Validating a value against regular expression
-def validate(var, regex, errMsg, exitCode):
-  debug('Validating ' + var + ' against ' + regex)
+# Validating a value against compiled regular expression
+def validate(var, pattern, errMsg, exitCode):
+  debug('Validating %s against %s', var, pattern.pattern)
+  if pattern.fullmatch(var):
+    debug('Validation successfull')
+  else:
+    print(errMsg)
+    sys.exit(exitCode)
+
+
+# Write file atomically
+# Data is written to a uniquely named temporary file in the same directory,
+# readable by its owner only, which then replaces the file. Concurrent runs
+# and other tools never see partially written file or overwrite each other's
+# temporary file.
+# arguments:
+#   - file path
+#   - data to write, string
+# returns: nothing, raises OSError on failure
+def writeFileAtomic(path, data):
+  fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + '.')
   try:
-    pattern = re.compile(regex)
-    if re.fullmatch(pattern, var):
-      debug('Validation successfull')
-    else:
-      print(errMsg)
-      exit(exitCode)
-  except ValueError as err:
-    print(err)
+    with os.fdopen(fd, 'w') as f:
+      f.write(data)
+    os.replace(tmpPath, path)
+  except OSError:
+    try:
+      os.remove(tmpPath)
+    except OSError:
+      pass
+    raise
+
+
+# Import boto3 and botocore on first use
+# boto3 takes a while to import, so it is not imported at module load:
+# `--help` and invalid arguments are reported without delay.
+# Called by awsClient() under awsClientsLock.
+# returns: nothing
+def importBoto3():
+  global boto3, Config
+  if boto3 is None:
+    debug('Importing boto3')
+    import boto3
+    from botocore.config import Config
+
+
+# Exceptions raised by boto3 clients
+# botocore is imported on first use as well, so helpers catch its
+# exceptions as `except awsErrors() as err`.
+# returns: tuple of BotoCoreError and ClientError classes
+def awsErrors():
+  from botocore.exceptions import BotoCoreError, ClientError
+  return (BotoCoreError, ClientError)
+
+
+# Get AWS client for service, profile and region
+# Clients are cached, so every helper working with the same profile
+# and region reuses one client and its HTTPS connection pool, and one
+# boto3 session is shared by all clients of the same profile.
+# boto3 sessions are not thread-safe, so clients are created under lock.
+# Throttled requests (ThrottlingException etc.) are retried by botocore.
+# arguments:
+#   - AWS service name
+#   - AWS profile
+#   - AWS region
+# returns: boto3 client
+def awsClient(service, profile, region):
+  with awsClientsLock:
+    if (service, profile, region) not in awsClients:
+      importBoto3()
+      debug('Creating %s client: %s:%s', service, profile, region)
+      if profile not in awsSessions:
+        awsSessions[profile] = boto3.Session(profile_name=profile)
+      config = Config(retries={'max_attempts': AWS_RETRY_ATTEMPTS, 'mode': 'adaptive'},
+                      max_pool_connections=MAX_AWS_THREADS)
+      awsClients[(service, profile, region)] = awsSessions[profile].client(service, region_name=region, config=config)
+    return awsClients[(service, profile, region)]
 
 
+# Get ECR client for AWS profile and region
+def ecrClient(profile, region):
+  return awsClient('ecr', profile, region)
+
 
 # Read repositories from AWS region
 def getRepos(profile, region):
-  debug('Retrieving repos: ' + profile + ':' + region)
-  cmd = 'aws ecr describe-repositories --profile ' + profile + ' --region ' + region
-  debug('Running command: ' + cmd)
-
-  p = subprocess.Popen(cmd.split(),
-                       stdout = subprocess.PIPE,
-                       stderr = subprocess.PIPE,
-                       #stdin  = subprocess.PIPE,
-                       universal_newlines = True)
-  stdout, stderr = p.communicate()
-
-  if p.returncode > 0:
-    # Shell error happened
-    print(stderr)
-    exit(errAWS)
-  else:
-    debug(stdout)
-    
-  # Convert JSON text to a list
-  j = json.loads(stdout)
-  
-  # Return .repositories[] property
-  return j['repositories']
+  debug('Retrieving repos: %s:%s', profile, region)
+  repos = []
+  try:
+    paginator = ecrClient(profile, region).get_paginator('describe_repositories')
+    for page in paginator.paginate(PaginationConfig={'PageSize': AWS_PAGE_SIZE}):
+      repos.extend(page['repositories'])
+  except awsErrors() as err:
+    raise AWSError(err) from err
+
+  return repos
   
 
 # Get list of images for AWS ECR repo
-def getRepoImages(profile, region, repositoryName):
-  info('Retrieving images for repository: ' + profile + ':' + region + ':' + repositoryName)
-  cmd = 'aws ecr describe-images --profile ' + profile + ' --region ' + region + ' --repository-name ' + repositoryName
-  debug('Running command: ' + cmd)
-
-  p = subprocess.Popen(cmd.split(),
-                       stdout = subprocess.PIPE,
-                       stderr = subprocess.PIPE,
-                       #stdin  = subprocess.PIPE,
-                       universal_newlines = True)
-  stdout, stderr = p.communicate()
-
-  if p.returncode > 0:
-    # Shell error happened
-    print(stderr)
-    exit(errAWS)
-  else:
-    debug(stdout)
-  
-  # Convert JSON text to a list
-  j = json.loads(stdout)
-  
-  # Return .imageDetails[] property
-  return j['imageDetails']  
+# Only the image properties listed in IMAGE_FIELDS are kept, so that
+# large repositories don't keep full AWS responses in memory
+# arguments:
+#   - AWS profile
+#   - AWS region
+#   - Repository name
+#   - Tag status filter applied by AWS: 'TAGGED', 'UNTAGGED' or 'ANY' (default)
+# returns: list of images, raises AWSError on AWS failure
+def getRepoImages(profile, region, repositoryName, tagStatus='ANY'):
+  info('Retrieving images for repository: %s:%s:%s', profile, region, repositoryName)
+  images = []
+  try:
+    paginator = ecrClient(profile, region).get_paginator('describe_images')
+    for page in paginator.paginate(repositoryName=repositoryName,
+                                   filter={'tagStatus': tagStatus},
+                                   PaginationConfig={'PageSize': AWS_PAGE_SIZE}):
+      for image in page['imageDetails']:
+        images.append({k: image[k] for k in IMAGE_FIELDS if k in image})
+  except awsErrors() as err:
+    raise AWSError(err) from err
+
+  return images
 
 
 # Create repository
@@ -118,598 +263,769 @@ def getRepoImages(profile, region, repositoryName):
 #   - AWS region
 #   - Name of repository to create
 #   = Whether to enable scan on push (boolean, default true)
-# returns: nothing
+# returns: nothing, raises AWSError on AWS failure
 def createRepo(profile, region, repositoryName, scanOnPush=True):
-  debug('Creating repository: ' + profile + ':' + region + ':' + repositoryName)
-  cmd = 'aws ecr create-repository --profile ' + profile + ' --region ' + region + ' --repository-name ' + repositoryName
-  if scanOnPush:
-    cmd = cmd + ' --image-scanning-configuration scanOnPush=true'
-  debug('Running command: ' + cmd)
-  p = subprocess.Popen(cmd.split(),
-                       stdout = subprocess.PIPE,
-                       stderr = subprocess.PIPE,
-                       #stdin  = subprocess.PIPE,
-                       universal_newlines = True)
-  stdout, stderr = p.communicate()
-
-  if p.returncode > 0:
-    # Shell error happened
-    print(stderr)
-    exit(errAWS)
-  else:
-    debug(stdout)
+  debug('Creating repository: %s:%s:%s', profile, region, repositoryName)
+  try:
+    r = ecrClient(profile, region).create_repository(
+      repositoryName=repositoryName,
+      imageScanningConfiguration={'scanOnPush': scanOnPush})
+  except awsErrors() as err:
+    raise AWSError(err) from err
+  debug(r['repository'])
 
   
 # Calculate age of image, in calendar days
-def imageAge(image):
-  pushedAt = re.sub("T.*", "", image['imagePushedAt'])
-  pushedDate = date.fromisoformat(pushedAt)
-  return ((date.today() - pushedDate).days)
+# arguments:
+#   - image
+#   - current date
+# returns: number of days
+def imageAge(image, today):
+  pushedDate = image['imagePushedAt'].date()
+  return ((today - pushedDate).days)
 
   
+# Path to cached ECR authorization token for profile and registry
+# A token carries permissions of the principal it was issued to, so tokens
+# are cached per profile, not shared by profiles of the same account. FQDN
+# includes account ID, so a profile switched to another account does not
+# reuse a token of the old one.
+def tokenCachePath(profile, FQDN):
+  cacheDir = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+  return os.path.join(cacheDir, TOKEN_CACHE_NAME, profile + '@' + FQDN + '.json')
+
+
+# Read cached ECR authorization token
+# arguments:
+#   - AWS profile
+#   - FQDN for ECR registry
+# returns: password, None if not cached or expires soon
+def readCachedToken(profile, FQDN):
+  path = tokenCachePath(profile, FQDN)
+  try:
+    with open(path) as f:
+      cache = json.load(f)
+    expiresAt = datetime.fromisoformat(cache['expiresAt'])
+    if datetime.now(timezone.utc) < expiresAt - TOKEN_EXPIRY_MARGIN:
+      return cache['password']
+    debug('Cached ECR authorization token in %s expires soon', path)
+  except FileNotFoundError:
+    pass
+  except (OSError, ValueError, KeyError, TypeError) as err:
+    debug('Could not read cached ECR authorization token from %s: %s', path, err)
+  return None
+
+
+# Store ECR authorization token in cache
+# File is readable by its owner only. Failures are not fatal.
+# arguments:
+#   - AWS profile
+#   - FQDN for ECR registry
+#   - password
+#   - token expiration time, timezone-aware datetime
+# returns: nothing
+def writeCachedToken(profile, FQDN, password, expiresAt):
+  path = tokenCachePath(profile, FQDN)
+  try:
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    writeFileAtomic(path, json.dumps({'password': password, 'expiresAt': expiresAt.isoformat()}))
+  except OSError as err:
+    debug('Could not cache ECR authorization token in %s: %s', path, err)
+
+
+# Remove cached ECR authorization token
+# Called when the registry rejects credentials, so that the token is not
+# reused by subsequent runs. Failures are not fatal.
+# arguments:
+#   - AWS profile
+#   - FQDN for ECR registry
+# returns: nothing
+def removeCachedToken(profile, FQDN):
+  path = tokenCachePath(profile, FQDN)
+  try:
+    os.remove(path)
+    debug('Cached ECR authorization token %s was removed', path)
+  except FileNotFoundError:
+    pass
+  except OSError as err:
+    debug('Could not remove cached ECR authorization token %s: %s', path, err)
+
+
 # Retrieve credentials for ECR repository  
-def getECRCredentials(profile, region):
-  info('Retrieving credentials for: ' + profile + ':' + region)
-  cmd = 'aws ecr get-login-password --region ' + region + ' --profile ' + profile
-
-  debug('Running command: ' + cmd)
-
-  p = subprocess.Popen(cmd.split(),
-                       stdout = subprocess.PIPE,
-                       stderr = subprocess.PIPE,
-                       #stdin  = subprocess.PIPE,
-                       universal_newlines = True)
-  stdout, stderr = p.communicate()
-
-  if p.returncode > 0:
-    # Shell error happened
-    print(stderr)
-    exit(errAWS)
+# Token is valid for 12 hours, so it is cached and reused by subsequent
+# runs, until TOKEN_EXPIRY_MARGIN before its expiration.
+# arguments:
+#   - AWS profile
+#   - AWS region
+#   - FQDN for ECR registry, cached token is kept per profile and FQDN
+#   - whether cached token may be used (boolean, default true)
+# returns: password, raises AWSError on AWS failure
+def getECRCredentials(profile, region, FQDN, useCache=True):
+  info('Retrieving credentials for: %s:%s', profile, region)
+  password = readCachedToken(profile, FQDN) if useCache else None
+  if password is not None:
+    debug('Using cached ECR authorization token')
   else:
-    if DEBUG_AUTH:
-      debug(stdout)
-    else:
-      debug('ECR authorization token was retrieved as <HIDDEN>')
-    return stdout.rstrip()
+    try:
+      r = ecrClient(profile, region).get_authorization_token()
+    except awsErrors() as err:
+      raise AWSError(err) from err
+
+    # Token is base64-encoded "AWS:<password>"
+    authorizationData = r['authorizationData'][0]
+    password = base64.b64decode(authorizationData['authorizationToken']).decode().split(':', 1)[1]
+    writeCachedToken(profile, FQDN, password, authorizationData['expiresAt'])
+
+  if DEBUG_AUTH:
+    debug(password)
+  else:
+    debug('ECR authorization token was retrieved as <HIDDEN>')
+  return password
 
 
 # Multipurpose docker runner
 # Allows to run `docker <command> <any arguments>`
+# Docker output is shown only in debug mode, otherwise it is discarded
+# instead of being buffered in memory; stderr is kept as bytes and
+# reported on failure.
 # arguments:
 #   - command for docker
-#   - arguments for docker command
-# returns subprocess stdout
-def dockerRunner(command, arguments):
-  cmd = 'docker ' + command + ' ' + arguments
-  debug('Running command: ' + cmd)
-  p = subprocess.Popen(cmd.split(),
-                       stdout = subprocess.PIPE,
-                       stderr = subprocess.PIPE,
-                       #stdin  = subprocess.PIPE,
-                       universal_newlines = True)
-  stdout, stderr = p.communicate()
-
-  if p.returncode > 0:
-    # Shell error happened
-    print(stderr)
-    exit(errDocker)
-  else:
-    return stdout
+#   - list of arguments for docker command
+#   - data to pass to docker stdin, e.g. password (optional)
+# returns: nothing, raises DockerError on docker failure,
+#          DockerAuthError if credentials were rejected
+def dockerRunner(command, arguments, stdin=None):
+  cmd = ['docker', command] + arguments
+  if DEBUG:
+    debug('Running command: %s', ' '.join(shlex.quote(arg) for arg in cmd))
+  p = subprocess.run(cmd,
+                     input = stdin.encode() if stdin is not None else None,
+                     stdout = None if DEBUG else subprocess.DEVNULL,
+                     stderr = subprocess.PIPE)
+
+  if p.returncode != 0:
+    # Docker failed or was killed by a signal (negative code), stderr is decoded only now
+    stderr = p.stderr.decode(errors='replace').rstrip()
+    if reDockerAuthError.search(stderr):
+      raise DockerAuthError(stderr)
+    raise DockerError(stderr)
   
 
+# Store registry credentials in docker config file
+# Docker reads credentials for pull and push from this file, so writing
+# them directly makes `docker login` subprocess unnecessary. This is not
+# possible when docker keeps credentials in a credentials store/helper.
+# arguments:
+#   - FQDN for ECR registry
+#   - password
+# returns: boolean, whether credentials were stored
+def dockerConfigLogin(FQDN, password):
+  configDir = os.environ.get('DOCKER_CONFIG', os.path.join(os.path.expanduser('~'), '.docker'))
+  configPath = os.path.join(configDir, 'config.json')
+  with dockerConfigLock:
+    try:
+      with open(configPath) as f:
+        config = json.load(f)
+    except FileNotFoundError:
+      config = {}
+    except (OSError, ValueError) as err:
+      debug('  could not read docker config %s: %s', configPath, err)
+      return False
+
+    if 'credsStore' in config or FQDN in config.get('credHelpers', {}):
+      debug('  docker uses credentials helper, config file is not updated')
+      return False
+
+    auth = base64.b64encode(('AWS:' + password).encode()).decode()
+    config.setdefault('auths', {})[FQDN] = {'auth': auth}
+    try:
+      os.makedirs(configDir, exist_ok=True)
+      writeFileAtomic(configPath, json.dumps(config, indent='\t'))
+    except OSError as err:
+      debug('  could not write docker config %s: %s', configPath, err)
+      return False
+
+  debug('  credentials were stored in %s', configPath)
+  return True
+
+
+# Check registry credentials with an authenticated request to registry API
+# Docker does not use credentials stored in config file until the first
+# pull or push, so they are checked here, as `docker login` would do.
+# Registry may be reachable only by docker daemon, e.g. via its own proxy
+# or remote DOCKER_HOST, so other failures are not fatal.
+# arguments:
+#   - FQDN for ECR registry
+#   - password
+# returns: boolean, whether credentials were checked,
+#          raises DockerAuthError if registry rejects credentials
+def checkRegistryLogin(FQDN, password):
+  debug('  checking credentials at https://%s/v2/', FQDN)
+  auth = base64.b64encode(('AWS:' + password).encode()).decode()
+  request = urllib.request.Request('https://' + FQDN + '/v2/', headers={'Authorization': 'Basic ' + auth})
+  try:
+    with urllib.request.urlopen(request, timeout=REGISTRY_TIMEOUT):
+      pass
+  except urllib.error.HTTPError as err:
+    if err.code in (401, 403):
+      raise DockerAuthError('Login to ' + FQDN + ' failed: ' + str(err.code) + ' ' + err.reason) from err
+    debug('  could not check credentials: %s %s', err.code, err.reason)
+    return False
+  except (OSError, http.client.HTTPException) as err:
+    debug('  could not check credentials: %s', err)
+    return False
+  return True
+
+
 # Docker login
+# Credentials are written to docker config file when possible, and are
+# checked at the registry. If either is not possible, `docker login` is
+# run. Password is passed to it via stdin, so it is not visible in the
+# process list.
 # arguments:
 #   - FQDN for ECR registry
 #   - password
-# returns: nothing, underlying docker runner exits on docker failure
+# returns: nothing, raises DockerError on docker failure,
+#          DockerAuthError if credentials were rejected
 def dockerLogin(FQDN, password):
-  info('Docker login to: ' + FQDN)
+  info('Docker login to: %s', FQDN)
   if DEBUG_AUTH:
-    debug('  using password: ' + password)
+    debug('  using password: %s', password)
   else:
     debug('  using password: <HIDDEN>')
 
-  if DEBUG_AUTH:
-    r = dockerRunner('login', '--username AWS --password ' + password + ' ' + FQDN)
-  else:
-    cmd = 'docker login --username AWS --password ' + password + ' ' + FQDN
-    debug('Running command: docker login --username AWS --password <HIDDEN> ' + FQDN)
-    p = subprocess.Popen(cmd.split(),
-                         stdout = subprocess.PIPE,
-                         stderr = subprocess.PIPE,
-                         universal_newlines = True)
-    stdout, stderr = p.communicate()
-
-    if p.returncode > 0:
-      # Shell error happened
-      print(stderr)
-      exit(errDocker)
-    else:
-      r = stdout
-  
-  print(r)
+  if dockerConfigLogin(FQDN, password) and checkRegistryLogin(FQDN, password):
+    return
+  dockerRunner('login', ['--username', 'AWS', '--password-stdin', FQDN], password)
 
   
 # Docker pull image
 # arguments:
 #   - full image name
-# returns: nothing, underlying docker runner exits on docker failure
+# returns: nothing, raises DockerError on docker failure
 def dockerPull(imageName):
-  info('Pulling image: ' + imageName)
-  r = dockerRunner('pull', imageName)
-  print(r)
+  info('Pulling image: %s', imageName)
+  dockerRunner('pull', ['--quiet', imageName])
 
     
 # Docker tag image
 # arguments:
 #   - full image name
 #   - new full image name
-# returns: nothing, underlying docker runner exits on docker failure
+# returns: nothing, raises DockerError on docker failure
 def dockerTag(imageName, newImageName):
-  info('Tagging image: ' + imageName + ' as ' + newImageName)
-  r = dockerRunner('tag', imageName + ' ' + newImageName)
-  print(r)
+  info('Tagging image: %s as %s', imageName, newImageName)
+  dockerRunner('tag', [imageName, newImageName])
     
     
 # Docker push image
 # arguments:
 #   - full image name
-# returns: nothing, underlying docker runner exits on docker failure
+# returns: nothing, raises DockerError on docker failure
 def dockerPush(imageName):
-  info('Pushing image: ' + imageName)
-  cmd = 'docker push ' + imageName
-  r = dockerRunner('push', imageName)
-  print(r)
+  info('Pushing image: %s', imageName)
+  dockerRunner('push', ['--quiet', imageName])
 
 
 # Docker remove local image
 # arguments:
 #   - full image name
-# returns: nothing, underlying docker runner exits on docker failure
+# returns: nothing, raises DockerError on docker failure
 def dockerRmi(imageName):
-  info('Removing image: ' + imageName)
-  cmd = 'docker rmi ' + imageName
-  r = dockerRunner('rmi', imageName)
-  print(r)
+  info('Removing image: %s', imageName)
+  dockerRunner('rmi', [imageName])
 
     
+# Copy image between ECR registries by its manifest only
+# No layers are transferred, so this succeeds only when the destination
+# repository already has all layers of the image, e.g. when the same
+# image is there under another tag. Otherwise the image should be
+# cloned with docker.
+# arguments:
+#   - source AWS profile
+#   - source AWS region
+#   - destination AWS profile
+#   - destination AWS region
+#   - repository name, same at both sides
+#   - image digest
+#   - image tag to put at destination
+# returns: boolean, whether the image was copied
+def copyImageManifest(srcProfile, srcRegion, dstProfile, dstRegion, repositoryName, digest, tag):
+  info('Copying manifest of image: %s:%s', repositoryName, tag)
+  BotoCoreError, ClientError = awsErrors()
+  try:
+    r = ecrClient(srcProfile, srcRegion).batch_get_image(repositoryName=repositoryName,
+                                                         imageIds=[{'imageDigest': digest}],
+                                                         acceptedMediaTypes=MANIFEST_MEDIA_TYPES)
+    if len(r['images']) == 0:
+      debug('  Image was not found at source')
+      return False
+    image = r['images'][0]
+    ecrClient(dstProfile, dstRegion).put_image(repositoryName=repositoryName,
+                                               imageManifest=image['imageManifest'],
+                                               imageManifestMediaType=image['imageManifestMediaType'],
+                                               imageTag=tag,
+                                               imageDigest=digest)
+  except ClientError as err:
+    if err.response['Error']['Code'] == 'ImageAlreadyExistsException':
+      return True
+    debug('  Could not copy manifest: %s', err)
+    return False
+  except BotoCoreError as err:
+    debug('  Could not copy manifest: %s', err)
+    return False
+
+  return True
+
+
 # Build ECR FQDN for profile
+# Account ID is retrieved with STS, which requires no IAM permissions.
+# Use it only when FQDN cannot be taken from any repository URI.
 # arguments:
 #   - AWS profile
 #   - AWS region
-# returns: FQDN for ECR in this profile and region
+# returns: FQDN for ECR in this profile and region, raises AWSError on AWS failure
 def buildFQDN(profile, region):
-  info('Generating ECR FQDN for profile: ' + profile)
-  cmd = 'aws ecr describe-registry --profile ' + profile
-
-  debug('Running command: ' + cmd)
-
-  p = subprocess.Popen(cmd.split(),
-                       stdout = subprocess.PIPE,
-                       stderr = subprocess.PIPE,
-                       #stdin  = subprocess.PIPE,
-                       universal_newlines = True)
-  stdout, stderr = p.communicate()
-
-  if p.returncode > 0:
-    # Shell error happened
-    print(stderr)
-    exit(errAWS)
-  else:
-    debug(stdout)
-    
-  # Convert JSON text to a list
-  j = json.loads(stdout)
+  info('Generating ECR FQDN for profile: %s', profile)
+  try:
+    r = awsClient('sts', profile, region).get_caller_identity()
+  except awsErrors() as err:
+    raise AWSError(err) from err
   
-  accountId = j['registryId']
+  accountId = r['Account']
   return str(accountId) + '.dkr.ecr.' + region + '.amazonaws.com'
 
 
-# Check if a repository with given name exists in repository list
-# arguments:
-#   - list of repositories (generated from JSON returned by AWS)
-#   - name of repository to check
-# returns: boolean
-def repoExists(repositoryList, repositoryName):
-  exists = False
-  for repo in repositoryList:
-    if repo['repositoryName'] == repositoryName:
-      debug('Repository ' + repositoryName + ' exists in the list')
-      exists = True
-      break
-  if not exists:
-      debug('Repository ' + repositoryName + ' does not exist in the list')
-
-  return exists
-
-
-# Describe image
+# Get ECR FQDN for profile
+# FQDN is taken from repository URI, which is <FQDN>/<repository name>,
+# so no AWS request is needed unless there are no repositories
 # arguments:
 #   - AWS profile
 #   - AWS region
-#   - Repository name
-#   - Image tag
-# returns: What AWS returns as JSON for the image, {} if does not exist
-def describeImage(profile, region, repositoryName, tag):
-  debug('Retrieving metadata for image: ' + profile + ':' + region + ', ' + repositoryName + ':' + tag)
-  cmd = 'aws ecr describe-images --profile ' + profile + ' --repository-name ' + repositoryName
-  debug('Running command: ' + cmd)
-
-  p = subprocess.Popen(cmd.split(),
-                       stdout = subprocess.PIPE,
-                       stderr = subprocess.PIPE,
-                       #stdin  = subprocess.PIPE,
-                       universal_newlines = True)
-  stdout, stderr = p.communicate()
-
-  if p.returncode > 0:
-    # Shell error happened
-    print(stderr)
-    exit(errAWS)
-  else:
-    debug(stdout)
-    
-  # Convert JSON text to a list
-  images = json.loads(stdout)['imageDetails']
-  for image in images:
-    if image['imageTags'][0] == tag:
-      debug('Found the image:')
-      debug(image)
-      return image
-  
-  # If such image is not found
-  return {}
-  
-
-  
-####################
-# MAIN PROCESS
-#
-
-
-####################
-# PART 1. Read and process arguments.
-#
-
-# Read CLI arguments
-parser = argparse.ArgumentParser(description='AWS ECR smart synchronization tool.\nSee https://github.com/dfad1ripe/aws-crossrepo for the details.')
-parser.add_argument('src_profile', type=str, help='Source AWS profile, as defined in ~/.aws/config')
-parser.add_argument('src_region', type=str, help='Source AWS region')
-parser.add_argument('dst_profile', type=str, help='Destination AWS profile, as defined in ~/.aws/config')
-parser.add_argument('dst_region', type=str, help='Destination AWS region')
-parser.add_argument('--days', '-d', type=int, default=30, help='How recent images to synchronize, in calendar days')
-parser.add_argument('--require-scan', '-s', type=bool, nargs='?', default=False, const=True, help='Clone only scanned images (default False)')
-parser.add_argument('--verbose', '-v', type=bool, nargs='?', default=False, const=True, help='More verbosity (default False)')
-parser.add_argument('--verbose-auth', '-vv', type=bool, nargs='?', default=False, const=True, help='Verbose authentication data (default False)')
-# Mutually exclusive arguments --exclude-repos and --include-repos
-bwListGroup = parser.add_mutually_exclusive_group()
-bwListGroup.add_argument('--exclude-repos', type=str, nargs='?', help='Comma-separated list of repositories to exclude from cloning ("black list")')
-bwListGroup.add_argument('--include-repos', type=str, nargs='?', help='Comma-separated list of repositories to include to cloning ("white list")')
-
-args = parser.parse_args()
-
-# Validating arguments
-debug('Validating parameters')
-validate(args.src_profile, "^[a-z0-9\-\_]+$", 'Invalid profile name: ' + args.src_profile, errInvalidArgument)
-validate(args.src_region, "^[a-z0-9\-]+$", 'Invalid region name: ' + args.src_region, errInvalidArgument)
-validate(args.dst_profile, "^[a-z0-9\-\_]+$", 'Invalid profile name: ' + args.dst_profile, errInvalidArgument)
-validate(args.dst_region, "^[a-z0-9\-]+$", 'Invalid region name: ' + args.dst_region, errInvalidArgument)
-
-if args.days < 1:
-  print('Invalid --days value: should be 1 or more')
-  exit(errInvalidArgument)
-
-if args.verbose:
-  DEBUG = True
-
-if args.verbose_auth:
-  DEBUG = True
-  DEBUG_AUTH = True
+#   - list of repositories in this profile and region
+# returns: FQDN for ECR in this profile and region
+def registryFQDN(profile, region, repoList):
+  if len(repoList) > 0:
+    return repoList[0]['repositoryUri'].split('/', 1)[0]
+  return buildFQDN(profile, region)
 
-  
-debug('')
 
 ####################
-# PART 2. Read ECR data and decide what to copy.
+# MAIN PROCESS
 #
+# arguments:
+#   - list of command line arguments, sys.argv is used by default
+# returns: nothing, exits with exit code on failure
+def main(argv=None):
+
+  ####################
+  # PART 1. Read and process arguments.
+  #
+
+  # Read CLI arguments
+  parser = argparse.ArgumentParser(description='AWS ECR smart synchronization tool.\nSee https://github.com/dfad1ripe/aws-crossrepo for the details.')
+  parser.add_argument('src_profile', type=str, help='Source AWS profile, as defined in ~/.aws/config')
+  parser.add_argument('src_region', type=str, help='Source AWS region')
+  parser.add_argument('dst_profile', type=str, help='Destination AWS profile, as defined in ~/.aws/config')
+  parser.add_argument('dst_region', type=str, help='Destination AWS region')
+  parser.add_argument('--days', '-d', type=int, default=30, help='How recent images to synchronize, in calendar days')
+  parser.add_argument('--require-scan', '-s', type=bool, nargs='?', default=False, const=True, help='Clone only scanned images (default False)')
+  parser.add_argument('--verbose', '-v', type=bool, nargs='?', default=False, const=True, help='More verbosity (default False)')
+  parser.add_argument('--verbose-auth', '-vv', type=bool, nargs='?', default=False, const=True, help='Verbose authentication data (default False)')
+  # Mutually exclusive arguments --exclude-repos and --include-repos
+  bwListGroup = parser.add_mutually_exclusive_group()
+  bwListGroup.add_argument('--exclude-repos', type=str, nargs='?', help='Comma-separated list of repositories to exclude from cloning ("black list")')
+  bwListGroup.add_argument('--include-repos', type=str, nargs='?', help='Comma-separated list of repositories to include to cloning ("white list")')
+
+  args = parser.parse_args(argv)
+
+  # Validating arguments
+  debug('Validating parameters')
+  validate(args.src_profile, reProfileName, 'Invalid profile name: ' + args.src_profile, errInvalidArgument)
+  validate(args.src_region, reRegionName, 'Invalid region name: ' + args.src_region, errInvalidArgument)
+  validate(args.dst_profile, reProfileName, 'Invalid profile name: ' + args.dst_profile, errInvalidArgument)
+  validate(args.dst_region, reRegionName, 'Invalid region name: ' + args.dst_region, errInvalidArgument)
+
+  if args.days < 1:
+    print('Invalid --days value: should be 1 or more')
+    sys.exit(errInvalidArgument)
+
+  # Current date, captured once per run, so that all images are aged against the same day
+  today = date.today()
+
+  # Images pushed before this time are too old to be cloned
+  # Push times returned by AWS are timezone-aware, so the cutoff is the
+  # local midnight of the cutoff date, and is compared with them directly
+  cutoffTime = datetime.combine(today - timedelta(days=args.days), time()).astimezone()
+
+  global DEBUG, DEBUG_AUTH
+  if args.verbose:
+    DEBUG = True
+
+  if args.verbose_auth:
+    DEBUG = True
+    DEBUG_AUTH = True
+
+  debug('')
+
+  ####################
+  # PART 2. Read ECR data and decide what to copy.
+  #
+
+  # Get repository lists for Source and Destination repos, concurrently
+  # We need Destination list to know if we have to create a repo pefore pushing an image
+  info('Retrieving list of repositories in %s:%s', args.src_profile, args.src_region)
+  info('Retrieving list of repositories in %s:%s', args.dst_profile, args.dst_region)
+  with ThreadPoolExecutor(max_workers=2, thread_name_prefix='repos') as executor:
+    futureSrc = executor.submit(getRepos, args.src_profile, args.src_region)
+    futureDst = executor.submit(getRepos, args.dst_profile, args.dst_region)
+  try:
+    repoListSrc = futureSrc.result()
+    repoListDst = futureDst.result()
+  except AWSError as err:
+    error(err)
+    sys.exit(errAWS)
+  debug(repoListSrc)
+  debug(repoListDst)
+  repoNamesDst = {repo['repositoryName'] for repo in repoListDst}
+  info('')
 
-# Get repository list for Source repo
-info('Retrieving list of repositories in ' + args.src_profile + ':' + args.src_region)
-repoListSrc = getRepos(args.src_profile, args.src_region)
-debug(repoListSrc)
-
-# Get repository list for Destination repo
-# We need this to know if we have to create a repo pefore pushing an image
-info('Retrieving list of repositories in ' + args.dst_profile + ':' + args.dst_region)
-repoListDst = getRepos(args.dst_profile, args.dst_region)
-debug(repoListDst)
-info('')
-
-if args.exclude_repos:
-  # No need to try-catch here, as it would convert any bad syntax to a string
-  repoListExclude = args.exclude_repos.split(',')
-  for repoExclude in repoListExclude:
-    validate(repoExclude, "^[a-zA-Z0-9\-\_]+$", 'Invalid repository name: ' + repoExclude, errInvalidArgument)
-    for index,repo in enumerate(repoListSrc):
-      if repo['repositoryName'] == repoExclude:
-        debug('Repository ' + repoExclude + ' was excluded from cloning')
-        repoListSrc.pop(index)
-    
-  
-if args.include_repos:
-  repoWhiteListSrc = []
-  # No need to try-catch here, as it would convert any bad syntax to a string
-  repoListInclude = args.include_repos.split(',')
-  for repoInclude in repoListInclude:
-    validate(repoInclude, "^[a-zA-Z0-9\-\_]+$", 'Invalid repository name: ' + repoInclude, errInvalidArgument)
-    for index,repo in enumerate(repoListSrc):
-      if repo['repositoryName'] == repoInclude:
-        debug('Repository ' + repo['repositoryName'] + ' is included to cloning')
-        repoWhiteListSrc.append(repo)
-      else:
-        debug('Repository ' + repo['repositoryName'] + ' was excluded from cloning')
-  repoListSrc = repoWhiteListSrc
-
-
-info('Retrieving list of images')
-imagesToSync = []
-
-for repo in repoListSrc:
-  images = getRepoImages(args.src_profile, args.src_region, repo['repositoryName'])
-  if len(images) == 0:
-    info('  Repository is empty, skipping')
-  else:
-    for image in images:
-    
-      # Some images might have no tags
-      try:
-        tag = image['imageTags'][0]
-      except (NameError, KeyError) as e:
-        info('  Found image: ' + image['repositoryName'] + ':' + image['imagePushedAt'])
-        info('    Image is not tagged, skipping')
-        continue
-        
-      info('  Found image: ' + image['repositoryName'] + ':' + tag)
-
-      # Is image too old to be cloned?
-      age = imageAge(image)
-      if age > args.days:
-        info('    Image is ' + str(age) + ' day(s) old, skipping')
-        continue
-      else:
-        debug('    Image is ' + str(age) + ' day(s) old')
-      
-      # If we requree an image to be scanned, is it?
-      if args.require_scan:
-        try:
-          scanStatus = image['imageScanStatus']['status']
-        except (NameError, KeyError) as e:
-          info('    Image is not scanned, skipping')
+  if args.exclude_repos:
+    # No need to try-catch here, as it would convert any bad syntax to a string
+    repoListExclude = args.exclude_repos.split(',')
+    for repoExclude in repoListExclude:
+      validate(repoExclude, reRepositoryName, 'Invalid repository name: ' + repoExclude, errInvalidArgument)
+      for index,repo in enumerate(repoListSrc):
+        if repo['repositoryName'] == repoExclude:
+          debug('Repository %s was excluded from cloning', repoExclude)
+          repoListSrc.pop(index)
+
+
+  if args.include_repos:
+    repoWhiteListSrc = []
+    # No need to try-catch here, as it would convert any bad syntax to a string
+    repoListInclude = args.include_repos.split(',')
+    for repoInclude in repoListInclude:
+      validate(repoInclude, reRepositoryName, 'Invalid repository name: ' + repoInclude, errInvalidArgument)
+      for index,repo in enumerate(repoListSrc):
+        if repo['repositoryName'] == repoInclude:
+          debug('Repository %s is included to cloning', repo['repositoryName'])
+          repoWhiteListSrc.append(repo)
+        else:
+          debug('Repository %s was excluded from cloning', repo['repositoryName'])
+    repoListSrc = repoWhiteListSrc
+
+  # If there are no repositories to clone from - report and exit
+
+  if len(repoListSrc) == 0:
+    print('No repositories to clone at source. Nothing to synchronize.')
+    sys.exit(0)
+
+
+  info('Retrieving list of images')
+  imagesToSync = []
+
+  # Image lists are retrieved for all repositories concurrently,
+  # results are returned in the same order as repoListSrc.
+  # Untagged images are never cloned, so AWS is asked to not return them.
+  repoNamesSrc = [repo['repositoryName'] for repo in repoListSrc]
+  try:
+    with ThreadPoolExecutor(max_workers=MAX_AWS_THREADS, thread_name_prefix='images') as executor:
+      repoImagesSrc = list(executor.map(lambda repositoryName: getRepoImages(args.src_profile, args.src_region, repositoryName, 'TAGGED'),
+                                        repoNamesSrc))
+  except AWSError as err:
+    error(err)
+    sys.exit(errAWS)
+
+  for repositoryName, images in zip(repoNamesSrc, repoImagesSrc):
+    if len(images) == 0:
+      info('  Repository %s has no tagged images, skipping', repositoryName)
+    else:
+      # Lines about found images are collected and printed once per repository
+      imagesOld = 0
+      report = []
+      for image in images:
+
+        # Is image too old to be cloned?
+        # Checked first, as on mature registries most images are rejected here.
+        # Compared with precalculated cutoff time; age is calculated for output only
+        if image['imagePushedAt'] < cutoffTime:
+          imagesOld = imagesOld + 1
+          if DEBUG:
+            debug('  Found image: %s:%s, %s day(s) old, skipping',
+                  image['repositoryName'], ','.join(image.get('imageTags', [])), imageAge(image, today))
           continue
-        info('    Image is scanned')
 
+        # Image name with all its tags, for output, as all tags are synchronized
+        # Untagged images are not returned by AWS, so every image has a tag
+        image['imageName'] = image['repositoryName'] + ':' + ','.join(image['imageTags'])
+
+        if DEBUG:
+          debug('  Image %s is %s day(s) old', image['imageName'], imageAge(image, today))
+
+        # If we requree an image to be scanned, is it?
+        # Single line of output is reported for each image
+        if args.require_scan:
+          try:
+            scanStatus = image['imageScanStatus']['status']
+          except (NameError, KeyError) as e:
+            report.append('  Found image: %s, not scanned, skipping' % image['imageName'])
+            continue
+          report.append('  Found image: %s, scanned' % image['imageName'])
+        else:
+          report.append('  Found image: %s' % image['imageName'])
+
+        imagesToSync.append(image)
+
+      # Old images are reported by count, not one by one
+      if imagesOld > 0:
+        report.append('  Repository %s: %s image(s) older than %s day(s), skipping' % (repositoryName, imagesOld, args.days))
+      if len(report) > 0:
+        info('\n'.join(report))
 
-      imagesToSync.append(image)
+  info('')
 
+  # If there is nothing to sync - report and exit
 
-info('')
+  if len(imagesToSync) == 0:
+    print('No images satisfy the given rules. Nothing to synchronize.')
+    sys.exit(0)
 
-# If there is nothing to sync - report and exit
+  info('Number of images to synchronize: %s', len(imagesToSync))
+  info('\n'.join('  ' + image['imageName'] for image in imagesToSync))
 
-if len(imagesToSync) == 0:
-  print('No images satisfy the given rules. Nothing to synchronize.')
-  exit(0)
+  info('')
 
-info('Number of images to synchronize: ' + str(len(imagesToSync)))
-for image in imagesToSync:
-  try:
-    tag = image['imageTags'][0]
-  except (NameError, KeyError) as e:
-    info('  ' + image['repositoryName'] + ':' + image['imagePushedAt'])
-  info('  ' + image['repositoryName'] + ':' + tag)
 
-info('')
+  ####################
+  # PART 3. Create missed repositories
+  #
 
-      
-####################
-# PART 3. Create missed repositories
-#
+  # Create repositories that exist in Source and don't exist in Destination
+  reposToCreate = sorted({image['repositoryName'] for image in imagesToSync} - repoNamesDst)
 
-# Create repositories that exist in Source and don't exist in Destination
-reposToCreate = []
-for image in imagesToSync:
-  repositoryName = image['repositoryName']
-  if repoExists(repoListDst, repositoryName):
-    continue
-  else:
-    if repositoryName not in reposToCreate:
-      reposToCreate.append(repositoryName)
+  if len(reposToCreate) > 0:
+    info('The following repositories are missed at destination and will be created:')
+    info(reposToCreate)
+    info('')
 
-if len(reposToCreate) > 0:
-  info('The following repositories are missed at destination and will be created:')
-  info(reposToCreate)
-  info('')
-  reposCreated = 0
-
-  # Defining thread class
-  class repoCreateThread(threading.Thread):
-    def __init__(self, name, profile, region, repositoryName):
-      threading.Thread.__init__(self)
-      self.name = name
-      self.profile = profile
-      self.region = region
-      self.repositoryName = repositoryName
-    def run(self):
-      global reposCreated
-      debug('Starting thread: ' + self.name)
-      createRepo(self.profile, self.region, self.repositoryName)
-      reposCreated = reposCreated + 1
-      info('  Repository ' + self.repositoryName + ' was created at ' + self.profile + ':' + self.region)
-      debug('Exiting thread ' + self.name)
-
-
-  # Running threads to create missed repositories
-  threads = []
-  for repo in reposToCreate:
-    debug('Creating repository ' + repo + ' at ' + args.dst_profile + ':' + args.dst_region)
-    repoCreate = repoCreateThread('creating repository ' + repo + ' at ' + args.dst_profile + ':' + args.dst_region,
-                                  args.dst_profile,
-                                  args.dst_region,
-                                  repo)
-    repoCreate.start()
-    threads.append(repoCreate)
-
-  # Waiting for all threads to complete
-  for t in threads:
-    t.join()
+    # Worker creating a single repository
+    # returns: boolean, whether the repository was created
+    def repoCreateWorker(profile, region, repositoryName):
+      debug('Creating repository %s at %s:%s', repositoryName, profile, region)
+      try:
+        createRepo(profile, region, repositoryName)
+      except AWSError as err:
+        error(err)
+        return False
+      info('  Repository %s was created at %s:%s', repositoryName, profile, region)
+      return True
+
+
+    # Running a limited number of threads to create missed repositories
+    with ThreadPoolExecutor(max_workers=MAX_AWS_THREADS, thread_name_prefix='create') as executor:
+      results = list(executor.map(lambda repo: repoCreateWorker(args.dst_profile, args.dst_region, repo),
+                                  reposToCreate))
+    debug('Multithreading part complete')
+
+    # Check if all missed repositories were created successfully
+    reposCreated = sum(results)
+    info('Successfuly created %s repositories of %s', reposCreated, len(reposToCreate))
+    if reposCreated < len(reposToCreate):
+      print('Could not create all repositories. Please review the messages below and fix the error.')
+      sys.exit(errAWS)
+    info('')
+
+
+  ####################
+  # PART 4. Docker login to both repositories
+  #
+
+  # Worker building ECR FQDN, retrieving ECR credentials and running docker login
+  # If credentials are rejected, e.g. cached token belongs to a principal
+  # the profile does not use anymore, cached token is removed and login is
+  # retried once with a new token.
+  # Errors raised by helpers are caught here to report them as result.
+  # returns: FQDN for ECR registry, None if login failed
+  def loginWorker(profile, region, repoList):
+    try:
+      FQDN = registryFQDN(profile, region, repoList)
+      creds = getECRCredentials(profile, region, FQDN)
+      try:
+        dockerLogin(FQDN, creds)
+      except DockerAuthError as err:
+        debug('Credentials were rejected, retrying with new token: %s', err)
+        removeCachedToken(profile, FQDN)
+        creds = getECRCredentials(profile, region, FQDN, useCache=False)
+        dockerLogin(FQDN, creds)
+    except (AWSError, DockerError) as err:
+      error(err)
+      return None
+    return FQDN
+
+
+  # Running docker login for both repositories in parallel
+  loginExecutor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='login')
+  loginFutures = [loginExecutor.submit(loginWorker, args.src_profile, args.src_region, repoListSrc),
+                  loginExecutor.submit(loginWorker, args.dst_profile, args.dst_region, repoListDst)]
+
+  # While docker login is running, main thread retrieves digests of images
+  # at destination, once per repository instead of one AWS request per image.
+  # Digests of tagged images tell which images are already synchronized;
+  # digests of all images, including untagged ones, tell which images
+  # already have their layers at destination.
+  # Repositories just created at destination are empty and are not requested.
+  repoNamesToCheck = [repositoryName for repositoryName in dict.fromkeys(image['repositoryName'] for image in imagesToSync)
+                      if repositoryName in repoNamesDst]
+  try:
+    with ThreadPoolExecutor(max_workers=MAX_AWS_THREADS, thread_name_prefix='digests') as executor:
+      repoImagesDst = list(executor.map(lambda repositoryName: getRepoImages(args.dst_profile, args.dst_region, repositoryName),
+                                        repoNamesToCheck))
+  except AWSError as err:
+    error(err)
+    sys.exit(errAWS)
+
+  dstDigests = {}
+  dstRepoDigests = set()
+  for repositoryName, images in zip(repoNamesToCheck, repoImagesDst):
+    for dstImage in images:
+      dstRepoDigests.add((repositoryName, dstImage['imageDigest']))
+      for tag in dstImage.get('imageTags', []):
+        dstDigests[(repositoryName, tag)] = dstImage['imageDigest']
+
+  # Waiting for login to complete
+  loginExecutor.shutdown()
   debug('Multithreading part complete')
 
-  # Check if all missed repositories were created successfully
-  info('Successfuly created ' + str(reposCreated) + ' repositories of ' + str(len(reposToCreate)))
-  if reposCreated < len(reposToCreate):
-    print('Could not create all repositories. Please review the messages below and fix the error.')
-    exit(errAWS)
+  # Check if docker login was successful for both repositories
+  fqdnSrc, fqdnDst = [f.result() for f in loginFutures]
+  threadsLogged = sum(f.result() is not None for f in loginFutures)
+  print('Successful login happened in ' + str(threadsLogged) + ' threads of 2')
+  if threadsLogged < 2:
+    print('Docker was not able to login. Please review the messages below and fix the error.')
+    sys.exit(errDocker)
+
+
+  ####################
+  # PART 5. Cloning images with docker
+  #
+
+  # All tags of an image are synchronized. Tags that point to the same
+  # digest at destination are dropped, the image is skipped if none is left.
+  info('Checking which images exist at destination and have same checksum')
+  imagesToSyncFinal = []
+  for srcImage in imagesToSync:
+    tags = [tag for tag in srcImage['imageTags']
+            if dstDigests.get((srcImage['repositoryName'], tag)) != srcImage['imageDigest']]
+    if len(tags) == 0:
+      info('  Image %s exists and has the same checksum, skipping', srcImage['imageName'])
+    else:
+      # Only tags to be copied are named, as the image is synced and reported under this name
+      imageName = srcImage['repositoryName'] + ':' + ','.join(tags)
+      info('  Image %s does not exist, or has different checksum, and should be copied', imageName)
+      imagesToSyncFinal.append(dict(srcImage, imageTags=tags, imageName=imageName))
   info('')
+  imagesToSync = imagesToSyncFinal
+
+  # Worker cloning a group of images with the same digest, each with all its tags
+  # If the same image already exists in destination repository, only its
+  # manifest is copied for every tag. Otherwise the image is pulled, once for
+  # the whole group, the first tag is pushed with docker, and the rest are
+  # added by copying the manifest, as the layers are at destination by then.
+  # Errors raised by helpers are caught here to report them as result.
+  # returns: list of booleans, whether each image was pushed with all tags
+  def pushPullWorker(images):
+    results = []
+    pulledName = None
+    namesToRemove = []
+    for image in images:
+      repositoryName = image['repositoryName']
+      digest = image['imageDigest']
+      tags = image['imageTags']
+      try:
+        if (repositoryName, digest) in dstRepoDigests:
+          tags = [tag for tag in tags
+                  if not copyImageManifest(args.src_profile, args.src_region, args.dst_profile, args.dst_region,
+                                           repositoryName, digest, tag)]
+          if len(tags) == 0:
+            results.append(True)
+            continue
+
+        imageName = repositoryName + ':' + tags[0]
+        debug('Starting push-pull for image %s', imageName)
+        if pulledName is None:
+          dockerPull(fqdnSrc + '/' + imageName)
+          pulledName = fqdnSrc + '/' + imageName
+          namesToRemove.append(pulledName)
+        dockerTag(pulledName, fqdnDst + '/' + imageName)
+        dockerPush(fqdnDst + '/' + imageName)
+        namesToRemove.append(fqdnDst + '/' + imageName)
+        for tag in tags[1:]:
+          if copyImageManifest(args.src_profile, args.src_region, args.dst_profile, args.dst_region,
+                               repositoryName, digest, tag):
+            continue
+          dockerTag(pulledName, fqdnDst + '/' + repositoryName + ':' + tag)
+          dockerPush(fqdnDst + '/' + repositoryName + ':' + tag)
+          namesToRemove.append(fqdnDst + '/' + repositoryName + ':' + tag)
+      except DockerAuthError as err:
+        # Token expired or was revoked during the run, so both cached
+        # tokens are dropped and the next run requests new ones
+        error(err)
+        removeCachedToken(args.src_profile, fqdnSrc)
+        removeCachedToken(args.dst_profile, fqdnDst)
+        results.append(False)
+        continue
+      except (AWSError, DockerError) as err:
+        error(err)
+        results.append(False)
+        continue
+      debug('Finished push-pull for image %s', imageName)
+      results.append(True)
+
+    # Images are pushed already, failed cleanup is reported but not counted
+    try:
+      for name in namesToRemove:
+        dockerRmi(name)
+    except DockerError as err:
+      error(err)
+    return results
+
+
+  # The same image may be stored in several source repositories.
+  # Such images are grouped by digest and cloned by one worker,
+  # so that each image is pulled from source only once.
+  imageGroups = {}
+  for image in imagesToSync:
+    imageGroups.setdefault(image['imageDigest'], []).append(image)
+  imagesToSync = [image for images in imageGroups.values() for image in images]
+  debug('%s images to clone have %s distinct digests', len(imagesToSync), len(imageGroups))
+
+  # Running a limited number of threads, so that docker daemon
+  # and ECR are not flooded when there are many images to clone
+  with ThreadPoolExecutor(max_workers=MAX_DOCKER_THREADS, thread_name_prefix='clone') as executor:
+    results = [pushed for groupResults in executor.map(pushPullWorker, imageGroups.values())
+               for pushed in groupResults]
+  debug('Multithreading part complete')
 
-  
-####################
-# PART 4. Docker login to both repositories
-#
-
-# Build FQDN for repositories
-fqdnSrc = re.sub("\/.*", "", repoListSrc[0]['repositoryUri'])
-fqdnDst = buildFQDN(args.dst_profile, args.dst_region)
-
-# Multithreading execution of docker login
-#
-# Initial structures
-threads = []
-threadsLogged = 0
-
-# Defining thread class
-class loginThread(threading.Thread):
-  def __init__(self, name, profile, region, FQDN):
-    threading.Thread.__init__(self)
-    self.name = name
-    self.profile = profile
-    self.region = region
-    self.FQDN = FQDN
-  def run(self):
-    global threadsLogged
-    debug('Starting thread: ' + self.name)
-    self.creds = getECRCredentials(self.profile, self.region)
-    dockerLogin(self.FQDN, self.creds)
-    threadsLogged = threadsLogged + 1
-    debug('Exiting thread ' + self.name)
-
-# Defining and running threads    
-loginThreadSrc = loginThread('login thread for source repository',
-                             args.src_profile,
-                             args.src_region,
-                             fqdnSrc)
-loginThreadSrc.start()
-threads.append(loginThreadSrc)
-
-loginThreadDst = loginThread('login thread for destination repository',
-                             args.dst_profile,
-                             args.dst_region,
-                             fqdnDst)
-loginThreadDst.start()
-threads.append(loginThreadDst)
-
-# Waiting for all threads to complete
-for t in threads:
-    t.join()
-debug('Multithreading part complete')
-
-# Check if docker login was successful for both repositories
-print('Successful login happened in ' + str(threadsLogged) + ' threads of 2')
-if threadsLogged < 2:
-  print('Docker was not able to login. Please review the messages below and fix the error.')
-  exit(errDocker)
-
-
-####################
-# PART 5. Cloning images with docker
-#
-
-imagesToSyncFinal = []
-for srcImage in imagesToSync:
-  shouldBeCopied = False
-  # Checking if sush image exists at destination
-  info('Checking if the image ' + srcImage['repositoryName'] + ':' + srcImage['imageTags'][0] + ' exists at destination and has same checksum')
-  dstImage = describeImage(args.dst_profile, args.dst_region, srcImage['repositoryName'], srcImage['imageTags'][0])
-  
-  try:
-    srcDigest = srcImage['imageDigest']
-    dstDigest = dstImage['imageDigest']
-    if srcDigest != dstDigest:
-      shouldBeCopied = True
-  except KeyError:
-    # This happens when there is no dstImage['imageDigest'], meaning no such image
-    shouldBeCopied = True
-  
-  if shouldBeCopied:
-    info('  Image does not exist, or has different checksum, and should be copied')
-    imagesToSyncFinal.append(srcImage)
+  imageNames = [image['imageName'] for image in imagesToSync]
+  imageNamesPushed = [imageName for imageName, pushed in zip(imageNames, results) if pushed]
+
+  # Check if all images were pushed successfully
+  info('Successfuly pushed %s images of %s', len(imageNamesPushed), len(imagesToSync))
+  if len(imageNamesPushed) < len(imagesToSync):
+    print('Could not push all images. Please review the messages below and fix the error.')
+    print('Images pushed successfully:')
+    for imageName in imageNamesPushed:
+      print('  ' + imageName)
+    print('Images not pushed:')
+    for imageName, pushed in zip(imageNames, results):
+      if not pushed:
+        print('  ' + imageName)  
+    sys.exit(errAWS)
   else:
-    info('  Image exists and has the same checksum, skipping')
-info('')
-imagesToSync = imagesToSyncFinal
-
-imagesPushed = 0
-imageNamesPushed = []
-
-# Defining thread class
-class pushPullThread(threading.Thread):
-  def __init__(self, name, imageName):
-    threading.Thread.__init__(self)
-    self.name = name
-    self.imageName = imageName
-  def run(self):
-    global fqdnSrc
-    global fqdnDst
-    global imagesPushed
-    debug('Starting thread: ' + self.name)
-    dockerPull(fqdnSrc + '/' + self.imageName)
-    dockerTag(self.imageName, fqdnDst + '/' + self.imageName)
-    dockerPush(fqdnDst + '/' + self.imageName)
-    imagesPushed = imagesPushed + 1
-    imageNamesPushed.append(self.imageName)
-    dockerRmi(fqdnSrc + '/' + self.imageName)
-    dockerRmi(fqdnDst + '/' + self.imageName)
-    debug('Exiting thread ' + self.name)
-
-
-# Defining and running threads
-threads = []
-for image in imagesToSync:
-  imageName = image['repositoryName'] + ':' + image['imageTags'][0]
-  pushPullRunner = pushPullThread('push-pull thread for image ' + imageName, imageName)
-  pushPullRunner.start()
-  threads.append(pushPullRunner)
-
-
-# Waiting for all threads to complete
-for t in threads:
-    t.join()
-debug('Multithreading part complete')
-
-# Check if all images were pushed successfully
-info('Successfuly pushed ' + str(imagesPushed) + ' images of ' + str(len(imagesToSync)))
-if imagesPushed < len(imagesToSync):
-  print('Could not push all images. Please review the messages below and fix the error.')
-  print('Images pushed successfully:')
-  for imageName in imageNamesPushed:
-    print('  ' + imageName)
-  print('Images not pushed:')
-  for image in imagesToSync:
-    imageName = image['repositoryName'] + ':' + image['imageTags'][0]
-    if imageName not in imageNamesPushed:
-      print('  ' + imageName)  
-  exit(errAWS)
-else:
-  print('All images were synchronized')
-print('')
+    print('All images were synchronized')
+  print('')
 
-  
+
+if __name__ == '__main__':
+  main()